@@ -4,11 +4,61 @@ Database setup and management for Malaysian Loan Bot
 Streamlined for Elestio deployment
 """
 
+import io
 import os
+import re
+import atexit
+import logging
+import warnings
+import uuid
+import hashlib
+import weakref
+import threading
+import orjson
+import redis
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
 import psycopg2.extras
+from psycopg2 import sql
+import psycopg2.pool
+from psycopg2.pool import ThreadedConnectionPool
+from collections import OrderedDict, namedtuple
+from collections.abc import Mapping
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from typing import Optional, Dict, List
+from operator import itemgetter
+from typing import Callable, Optional, Dict, Hashable, Iterable, Iterator, List, Sequence, Tuple
+
+logger = logging.getLogger("loanbot")
+
+# Maximum number of server-side prepared statements kept per connection
+STATEMENT_CACHE_SIZE = 500
+
+# SQL-level PREPARE is session state; turn it off behind a transaction-mode pooler (PgBouncer)
+PREPARED_STATEMENTS = os.getenv('DB_PREPARED_STATEMENTS', 'true').lower() != 'false'
+
+# Buffered INSERTs are written once this many rows or this many seconds accumulate
+BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', '48'))
+BATCH_MAX_DELAY = int(os.getenv('DB_BATCH_MAX_DELAY_MS', '250')) / 1000
+
+# psycopg2 formats %s placeholders and %% escapes in queries run with parameters
+_PLACEHOLDER = re.compile(r'%%|%s')
+
+# Errors after which a cached prepared statement can no longer be trusted
+# (InFailedSqlTransaction is not one: the statement was never run and is still valid)
+_STALE_STATEMENT_ERRORS = (
+    psycopg2.errors.InvalidSqlStatementName,
+    psycopg2.errors.FeatureNotSupported,  # "cached plan must not change result type"
+)
+
+class _CachingConnection(psycopg2.extensions.connection):
+    """Connection that keeps track of its own prepared statements"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Query text -> prepared statement name, in LRU order
+        self.stmt_cache: "OrderedDict[str, str]" = OrderedDict()
 
 class DatabaseManager:
     """Database connection and query management"""
@@ -21,48 +71,379 @@ class DatabaseManager:
             'password': os.getenv('POSTGRES_PASSWORD'),
             'port': 5432
         }
-        self.connection = None
+        self.min_connections = int(os.getenv('DB_POOL_MIN', '2'))
+        self.max_connections = int(os.getenv('DB_POOL_MAX', '16'))
+        # Seconds to wait for a free connection before giving up
+        self.pool_timeout = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+        # ThreadedConnectionPool raises instead of waiting when exhausted
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        # Connection bound to the current thread by transaction()
+        self._local = threading.local()
+        self.pool = None
         self.connect()
     
     def connect(self):
-        """Establish database connection"""
+        """Create the database connection pool"""
         try:
-            self.connection = psycopg2.connect(**self.db_config)
-            self.connection.autocommit = True
-            print("✅ Database connected")
+            self.pool = ThreadedConnectionPool(
+                self.min_connections, self.max_connections,
+                connection_factory=_CachingConnection, **self.db_config
+            )
+            logger.info("✅ Database connected")
         except Exception as e:
-            print(f"❌ Database connection failed: {e}")
-            self.connection = None
+            logger.error("❌ Database connection failed: %s", e)
+            self.pool = None
     
-    def execute_query(self, query: str, params: tuple = None) -> Optional[List[Dict]]:
-        """Execute database query safely"""
-        if not self.connection:
+    @property
+    def in_transaction(self) -> bool:
+        """Whether the current thread is inside a transaction() block"""
+        return getattr(self._local, 'conn', None) is not None
+    
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed queries on one connection as a single transaction"""
+        if self.in_transaction:
+            # Nested blocks join the outer transaction
+            yield
+            return
+        
+        if not self.pool:
             self.connect()
             
-        if not self.connection:
+        if not self.pool:
+            raise psycopg2.OperationalError("no database connection")
+            
+        with self._borrow() as conn:
+            conn.autocommit = False
+            self._local.conn = conn
+            try:
+                yield
+                # execute_query swallows errors, so check the transaction survived
+                if conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+                    raise psycopg2.InternalError("transaction aborted by a failed statement")
+                conn.commit()
+            except BaseException:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                self._local.conn = None
+    
+    @contextmanager
+    def _borrow(self, detached: bool = False):
+        """Check a connection out of the pool for the duration of the block
+        
+        Inside transaction() the transaction's connection is reused unless detached is set.
+        """
+        conn = None if detached else getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+        
+        # Bounded wait: a thread holding a slot (e.g. an open stream) may be the one waiting
+        if not self._slots.acquire(timeout=self.pool_timeout):
+            raise psycopg2.pool.PoolError(
+                f"no free database connection after {self.pool_timeout:g}s")
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        conn.autocommit = True
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            # Only the broken connection is recycled, the rest of the pool stays warm
+            self.pool.putconn(conn, close=broken or bool(conn.closed))
+            self._slots.release()
+    
+    def _prepare(self, cursor, query: str) -> str:
+        """Return the name of the prepared statement for query, preparing it if needed"""
+        stmt_cache = cursor.connection.stmt_cache
+        name = stmt_cache.get(query)
+        if name is not None:
+            stmt_cache.move_to_end(query)
+            return name
+        
+        name = 's_' + hashlib.blake2b(query.encode()).hexdigest()[:16]
+        position = iter(range(1, len(_PLACEHOLDER.findall(query)) + 1))
+        body = _PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else f"${next(position)}", query)
+        prepare = sql.SQL("PREPARE {} AS ").format(sql.Identifier(name)) + sql.SQL(body)
+        # Inside transaction() a failed PREPARE would abort the caller's transaction
+        savepoint = not cursor.connection.autocommit
+        if savepoint:
+            cursor.execute("SAVEPOINT prepare_statement")
+        try:
+            cursor.execute(prepare)
+        except psycopg2.errors.DuplicatePreparedStatement:
+            # Left behind by a cache entry dropped without DEALLOCATE; its plan may be stale
+            if savepoint:
+                cursor.execute("ROLLBACK TO SAVEPOINT prepare_statement")
+            cursor.execute(sql.SQL("DEALLOCATE {}").format(sql.Identifier(name)))
+            cursor.execute(prepare)
+        if savepoint:
+            cursor.execute("RELEASE SAVEPOINT prepare_statement")
+        
+        stmt_cache[query] = name
+        if len(stmt_cache) > STATEMENT_CACHE_SIZE:
+            _, evicted = stmt_cache.popitem(last=False)
+            cursor.execute(sql.SQL("DEALLOCATE {}").format(sql.Identifier(evicted)))
+        return name
+    
+    def _invalidate(self, conn, query: str):
+        """Forget the prepared statement for query after it failed"""
+        name = conn.stmt_cache.pop(query, None)
+        if name is None or conn.closed:
+            return
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql.SQL("DEALLOCATE {}").format(sql.Identifier(name)))
+            cursor.close()
+        except psycopg2.Error:
+            pass
+    
+    def execute_query(self, query: str, params: tuple = None, cursor_factory=None) -> Optional[List]:
+        """Execute database query safely
+        
+        Rows are RealDictRow objects unless another cursor_factory is given.
+        Only queries with positional (%s) parameters are prepared; queries with
+        named parameters or none run as plain statements.
+        """
+        if not self.pool:
+            self.connect()
+            
+        if not self.pool:
             return None
             
+        if not isinstance(params, Mapping):
+            params = tuple(params or ())
         try:
-            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            cursor.execute(query, params or ())
+            with self._borrow() as conn:
+                try:
+                    cursor = conn.cursor(cursor_factory=cursor_factory or psycopg2.extras.RealDictCursor)
+                    if PREPARED_STATEMENTS and params and isinstance(params, tuple):
+                        name = self._prepare(cursor, query)
+                        placeholders = sql.SQL(', ').join(sql.Placeholder() * len(params))
+                        statement = sql.SQL("EXECUTE {} ({})").format(sql.Identifier(name), placeholders)
+                        cursor.execute(statement, params)
+                    else:
+                        cursor.execute(query, params or None)
+                    
+                    # SELECTs and writes with RETURNING both produce rows
+                    if cursor.description is not None:
+                        result = cursor.fetchall()
+                        cursor.close()
+                        # Rows are returned as built by the cursor, no need to copy them
+                        return result
+                    else:
+                        cursor.close()
+                        return []
+                except _STALE_STATEMENT_ERRORS:
+                    self._invalidate(conn, query)
+                    raise
+                
+        except Exception as e:
+            logger.error("❌ Query execution error: %s", e)
+            return None
+    
+    def execute_query_stream(self, query: str, params: tuple = None,
+                             itersize: int = 1000) -> Iterator[psycopg2.extras.RealDictRow]:
+        """Stream query results through a server-side cursor, itersize rows at a time
+        
+        Errors are logged and re-raised, so a failed stream is never mistaken for a complete one.
+        """
+        if not self.pool:
+            self.connect()
+            
+        if not self.pool:
+            raise psycopg2.OperationalError("no database connection")
             
-            if query.strip().upper().startswith('SELECT'):
-                result = cursor.fetchall()
+        try:
+            in_transaction = self.in_transaction
+            with self._borrow() as conn:
+                # Named cursors live inside a transaction
+                conn.autocommit = False
+                try:
+                    cursor = conn.cursor(name=f"stream_{uuid.uuid4().hex}",
+                                         cursor_factory=psycopg2.extras.RealDictCursor)
+                    cursor.itersize = itersize
+                    cursor.execute(query, params or ())
+                    yield from cursor
+                    cursor.close()
+                finally:
+                    if not in_transaction:
+                        conn.rollback()
+        except Exception as e:
+            logger.error("❌ Query stream error: %s", e)
+            raise
+    
+    def execute_batch(self, query: str, rows: List[tuple], page_size: int = 100,
+                      detached: bool = False) -> bool:
+        """Insert many rows with one multi-row statement per page
+        
+        detached commits on a connection of its own even inside transaction().
+        """
+        if not self.pool:
+            self.connect()
+            
+        if not self.pool:
+            return False
+            
+        try:
+            with self._borrow(detached) as conn:
+                cursor = conn.cursor()
+                psycopg2.extras.execute_values(cursor, query, rows, page_size=page_size)
                 cursor.close()
-                return [dict(row) for row in result]
-            else:
+            return True
+        except Exception as e:
+            logger.error("❌ Batch execution error (%d rows): %s", len(rows), e)
+            return False
+    
+    def copy_rows(self, table: str, columns: Sequence[str], rows: Iterable[tuple]) -> bool:
+        """Bulk load rows with COPY FROM STDIN in a single transaction"""
+        if not self.pool:
+            self.connect()
+            
+        if not self.pool:
+            return False
+            
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write(','.join(map(_csv_field, row)))
+            buffer.write('\n')
+        buffer.seek(0)
+        statement = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            sql.Identifier(table), sql.SQL(', ').join(map(sql.Identifier, columns))
+        )
+        try:
+            in_transaction = self.in_transaction
+            with self._borrow() as conn:
+                if not in_transaction:
+                    conn.autocommit = False
+                # Inside transaction() the enclosing block commits
+                with nullcontext() if in_transaction else conn:
+                    cursor = conn.cursor()
+                    cursor.copy_expert(statement.as_string(conn), buffer)
+                    cursor.close()
+            return True
+        except Exception as e:
+            logger.error("❌ Bulk copy error: %s", e)
+            return False
+    
+    def execute_ddl(self, statement: str) -> bool:
+        """Run a schema statement directly (utility statements cannot be PREPAREd)"""
+        if not self.pool:
+            self.connect()
+            
+        if not self.pool:
+            return False
+            
+        try:
+            with self._borrow() as conn:
+                cursor = conn.cursor()
+                cursor.execute(statement)
                 cursor.close()
-                return []
-                
+            return True
         except Exception as e:
-            print(f"❌ Query execution error: {e}")
-            return None
+            logger.error("❌ Schema statement error: %s", e)
+            return False
     
     def close(self):
-        """Close database connection"""
-        if self.connection:
-            self.connection.close()
-            print("✅ Database connection closed")
+        """Close all pooled database connections"""
+        if self.pool:
+            self.pool.closeall()
+            self.pool = None
+            logger.info("✅ Database connection closed")
+
+# Live BatchWriters, flushed once at interpreter exit without being kept alive by it
+_batch_writers: "weakref.WeakSet[BatchWriter]" = weakref.WeakSet()
+
+@atexit.register
+def _flush_batch_writers():
+    for writer in list(_batch_writers):
+        writer.flush()
+
+class BatchWriter:
+    """Coalesce single-row INSERTs into multi-row batches
+    
+    Queued rows are always written on a pooled connection of their own, so they
+    never join (or roll back with) a transaction() that happens to trigger a flush.
+    """
+    
+    def __init__(self, db_manager: DatabaseManager, query: str,
+                 batch_size: int = BATCH_SIZE, max_delay: float = BATCH_MAX_DELAY,
+                 key: Optional[Callable[[tuple], Hashable]] = None):
+        self.db = db_manager
+        self.query = query
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        # Groups rows for flush(key=...), e.g. by customer
+        self.key = key
+        self._pending: List[tuple] = []
+        self._lock = threading.Lock()
+        # Held while rows are being written, so flush() returns only once they are committed
+        self._write_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        _batch_writers.add(self)
+    
+    def add(self, row: tuple) -> bool:
+        """Queue a row, writing the batch once it is full"""
+        if self.db.in_transaction:
+            # Write through so the row commits or rolls back with the transaction
+            return self.db.execute_batch(self.query, [row])
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) < self.batch_size:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return True
+        return self.flush()
+    
+    def flush(self, key: Optional[Hashable] = None) -> bool:
+        """Write queued rows now, after any write already in progress has committed
+        
+        With key, only the rows in that group are written and the rest keep batching.
+        """
+        with self._write_lock:
+            with self._lock:
+                rows = self._take(key)
+            if not rows:
+                return True
+            return self._write(rows)
+    
+    def _write(self, rows: List[tuple]) -> bool:
+        """Insert rows as one batch, falling back to row by row if the batch fails"""
+        if self.db.execute_batch(self.query, rows, detached=True):
+            return True
+        if len(rows) == 1:
+            return False
+        # One bad row fails the whole statement; retry singly so only that row is lost
+        logger.warning("⚠️ Retrying %d batched rows one at a time", len(rows))
+        written = sum(self.db.execute_batch(self.query, [row], detached=True) for row in rows)
+        if written < len(rows):
+            logger.error("❌ %d of %d batched rows lost", len(rows) - written, len(rows))
+        return written == len(rows)
+    
+    def _take(self, key: Optional[Hashable] = None) -> List[tuple]:
+        """Detach the pending rows, or those in the key group (caller holds the lock)"""
+        if key is None:
+            rows, self._pending = self._pending, []
+        else:
+            rows = [row for row in self._pending if self.key(row) == key]
+            if rows:
+                self._pending = [row for row in self._pending if self.key(row) != key]
+        if not self._pending and self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return rows
 
 class ClientManager:
     """Manage client information and configurations"""
@@ -72,35 +453,204 @@ class ClientManager:
     
     def get_client_info(self, client_id: str) -> Optional[Dict]:
         """Get client information"""
-        query = "SELECT * FROM clients WHERE client_id = %s"
+        query = """
+        SELECT client_id, client_name, phone_number, email, status
+        FROM clients WHERE client_id = %s
+        """
         results = self.db.execute_query(query, (client_id,))
         return results[0] if results else None
     
-    def update_client_status(self, client_id: str, status: str) -> bool:
-        """Update client status"""
-        query = "UPDATE clients SET status = %s, updated_at = %s WHERE client_id = %s"
-        result = self.db.execute_query(query, (status, datetime.now(), client_id))
-        return result is not None
+    def update_client_status(self, client_id: str, status: str) -> Optional[Dict]:
+        """Update client status and return the updated row"""
+        query = """
+        UPDATE clients SET status = %s, updated_at = now() WHERE client_id = %s
+        RETURNING client_id, status, updated_at
+        """
+        results = self.db.execute_query(query, (status, client_id))
+        return results[0] if results else None
+
+def _csv_field(value) -> str:
+    """Format a value for COPY ... WITH (FORMAT csv); only NULL is left unquoted"""
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+# Conversation history rows have a fixed shape, so they are read as namedtuples
+CONV_CURSOR = psycopg2.extras.NamedTupleCursor
+
+ConversationRow = namedtuple('ConversationRow', 'message_text response_text timestamp customer_name')
+
+# Recent history kept per customer in Redis, and for how long (seconds)
+HISTORY_CACHE_SIZE = 10
+HISTORY_CACHE_TTL = 24 * 60 * 60
+
+def _history_key(client_id: str, phone_number: str) -> str:
+    return f"hist:{client_id}:{phone_number}"
+
+def _history_version_key(client_id: str, phone_number: str) -> str:
+    # Bumped on every save, so a fill that raced with a save can be detected
+    return f"histver:{client_id}:{phone_number}"
+
+def _encode_history_row(row: ConversationRow) -> bytes:
+    return orjson.dumps(tuple(row))
+
+def _decode_history_row(data: bytes) -> ConversationRow:
+    message_text, response_text, timestamp, customer_name = orjson.loads(data)
+    return ConversationRow(message_text, response_text, datetime.fromisoformat(timestamp), customer_name)
+
+_redis_pool: Optional[redis.ConnectionPool] = None
+
+def create_redis_client() -> redis.Redis:
+    """Redis client for the history cache, configured from the environment
+    
+    All clients share one connection pool, so concurrent handlers reuse
+    sockets instead of connecting per call.
+    """
+    global _redis_pool
+    if _redis_pool is None:
+        # Blocking pool: wait briefly for a free connection instead of failing
+        _redis_pool = redis.BlockingConnectionPool(
+            host=os.getenv('REDIS_HOST', 'redis'), port=6379,
+            max_connections=int(os.getenv('REDIS_MAX_CONNECTIONS', '32')), timeout=1,
+            socket_timeout=0.5, socket_connect_timeout=0.5,
+        )
+    return redis.Redis(connection_pool=_redis_pool)
 
 class ConversationTracker:
     """Track and manage customer conversations"""
     
-    def __init__(self, db_manager: DatabaseManager):
+    def __init__(self, db_manager: DatabaseManager, redis_client: Optional[redis.Redis] = None):
         self.db = db_manager
+        # Optional cache of the latest HISTORY_CACHE_SIZE messages per customer
+        self.redis = redis_client
+        # timestamp comes from the column default (clock_timestamp(), distinct per row)
+        self._writer = BatchWriter(db_manager, """
+        INSERT INTO conversations (client_id, phone_number, customer_name, message_text, response_text)
+        VALUES %s
+        """, key=itemgetter(0, 1))
     
     def save_conversation(self, client_id: str, phone_number: str, message_text: str, 
                          response_text: str = None, customer_name: str = None) -> bool:
-        """Save conversation to database"""
+        """Queue conversation for the next batched insert"""
+        params = (client_id, phone_number, customer_name, message_text, response_text)
+        saved = self._writer.add(params)
+        if self.redis is not None:
+            # Queued rows may still fail to write, so drop the cache instead of adding to it;
+            # this must follow add() so a reader that misses afterwards flushes the row
+            self._cache_invalidate(client_id, phone_number)
+        return saved
+    
+    def _cache_invalidate(self, client_id: str, phone_number: str):
+        """Drop the cached history and bump its version so in-flight fills are discarded"""
+        version_key = _history_version_key(client_id, phone_number)
+        try:
+            pipe = self.redis.pipeline()
+            pipe.incr(version_key)
+            pipe.expire(version_key, HISTORY_CACHE_TTL)
+            pipe.delete(_history_key(client_id, phone_number))
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning("⚠️ History cache invalidation failed: %s", e)
+    
+    def _cache_fill(self, client_id: str, phone_number: str, rows: List, version: Optional[bytes]):
+        """Replace the cached history with rows read from the database (newest first)
+        
+        Skipped when a save bumped the version since it was read, as the rows may miss it.
+        """
+        key = _history_key(client_id, phone_number)
+        version_key = _history_version_key(client_id, phone_number)
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.watch(version_key)
+                if pipe.get(version_key) != version:
+                    return
+                pipe.multi()
+                pipe.delete(key)
+                pipe.rpush(key, *(_encode_history_row(row) for row in rows))
+                pipe.expire(key, HISTORY_CACHE_TTL)
+                pipe.execute()
+        except redis.WatchError:
+            # A save landed between the check and the write; the next read refills
+            pass
+        except redis.RedisError as e:
+            logger.warning("⚠️ History cache fill failed: %s", e)
+    
+    def bulk_save_conversations(self, conversations: Iterable[tuple]) -> bool:
+        """Bulk load archived conversations with COPY (for imports and backfills)
+        
+        Each row is (client_id, phone_number, customer_name, message_text,
+        response_text, timestamp).
+        """
+        columns = ('client_id', 'phone_number', 'customer_name',
+                   'message_text', 'response_text', 'timestamp')
+        touched = set()
+        
+        def track(rows):
+            for row in rows:
+                touched.add((row[0], row[1]))
+                yield row
+        
+        saved = self.db.copy_rows('conversations', columns, track(conversations))
+        if saved and self.redis is not None:
+            for client_id, phone_number in touched:
+                self._cache_invalidate(client_id, phone_number)
+        return saved
+    
+    def get_history_and_stats(self, phone_number: str, client_id: str,
+                              limit: int = 10) -> Tuple[List[ConversationRow], Dict]:
+        """Get recent conversation history and interaction statistics in one query
+        
+        History rows are ConversationRow namedtuples; call _asdict() where a
+        dict is needed (e.g. when serializing).
+        """
         query = """
-        INSERT INTO conversations (client_id, phone_number, customer_name, message_text, response_text, timestamp)
-        VALUES (%s, %s, %s, %s, %s, %s)
+        SELECT message_text, response_text, timestamp, customer_name,
+               COUNT(*) OVER() AS total_messages,
+               MAX(timestamp) OVER() AS last_interaction,
+               MIN(timestamp) OVER() AS first_interaction
+        FROM conversations 
+        WHERE phone_number = %s AND client_id = %s
+        ORDER BY timestamp DESC 
+        LIMIT %s
         """
-        params = (client_id, phone_number, customer_name, message_text, response_text, datetime.now())
-        result = self.db.execute_query(query, params)
-        return result is not None
+        self._writer.flush((client_id, phone_number))
+        results = self.db.execute_query(query, (phone_number, client_id, limit),
+                                        cursor_factory=CONV_CURSOR) or []
+        if not results:
+            return [], {'total_messages': 0, 'last_interaction': None, 'first_interaction': None}
+        
+        first = results[0]
+        stats = {
+            'total_messages': first.total_messages,
+            'last_interaction': first.last_interaction,
+            'first_interaction': first.first_interaction,
+        }
+        history = [ConversationRow._make(row[:4]) for row in results]
+        return history, stats
     
-    def get_conversation_history(self, phone_number: str, client_id: str, limit: int = 10) -> List[Dict]:
-        """Get conversation history for a customer"""
+    def get_conversation_history(self, phone_number: str, client_id: str, limit: int = 10) -> List[ConversationRow]:
+        """Get conversation history for a customer, newest first
+        
+        Served from the Redis cache when one is configured; use
+        get_history_and_stats when interaction statistics are needed too.
+        """
+        cacheable = self.redis is not None and 0 < limit <= HISTORY_CACHE_SIZE
+        fill = False
+        version = None
+        if cacheable:
+            try:
+                pipe = self.redis.pipeline(transaction=False)
+                pipe.lrange(_history_key(client_id, phone_number), 0, limit - 1)
+                pipe.get(_history_version_key(client_id, phone_number))
+                cached, version = pipe.execute()
+                if cached:
+                    return [_decode_history_row(item) for item in cached]
+                fill = True
+            except redis.RedisError as e:
+                logger.warning("⚠️ History cache read failed: %s", e)
+        
+        # Make this customer's queued and in-flight rows visible before reading
+        self._writer.flush((client_id, phone_number))
         query = """
         SELECT message_text, response_text, timestamp, customer_name
         FROM conversations 
@@ -108,11 +658,41 @@ class ConversationTracker:
         ORDER BY timestamp DESC 
         LIMIT %s
         """
-        results = self.db.execute_query(query, (phone_number, client_id, limit))
-        return results or []
+        fetch = HISTORY_CACHE_SIZE if cacheable else limit
+        results = self.db.execute_query(query, (phone_number, client_id, fetch),
+                                        cursor_factory=CONV_CURSOR) or []
+        history = [ConversationRow._make(row) for row in results]
+        if fill and history:
+            self._cache_fill(client_id, phone_number, history, version)
+        return history[:limit]
+    
+    def export_conversations(self, client_id: str, itersize: int = 1000) -> Iterator[Dict]:
+        """Stream every conversation of a client, oldest first"""
+        query = """
+        SELECT phone_number, customer_name, message_text, response_text, timestamp
+        FROM conversations 
+        WHERE client_id = %s
+        ORDER BY timestamp
+        """
+        self._writer.flush()
+        return self.db.execute_query_stream(query, (client_id,), itersize=itersize)
+    
+    def has_any_conversation(self, phone_number: str, client_id: str) -> bool:
+        """Check whether a customer has talked to us before (stops at the first row)"""
+        query = """
+        SELECT EXISTS(
+            SELECT 1 FROM conversations 
+            WHERE phone_number = %s AND client_id = %s
+        ) AS found
+        """
+        self._writer.flush((client_id, phone_number))
+        results = self.db.execute_query(query, (phone_number, client_id))
+        return bool(results and results[0]['found'])
     
     def get_customer_stats(self, phone_number: str, client_id: str) -> Dict:
         """Get customer interaction statistics"""
+        warnings.warn("get_customer_stats is deprecated, use get_history_and_stats",
+                      DeprecationWarning, stacklevel=2)
         query = """
         SELECT 
             COUNT(*) as total_messages,
@@ -121,6 +701,7 @@ class ConversationTracker:
         FROM conversations 
         WHERE phone_number = %s AND client_id = %s
         """
+        self._writer.flush((client_id, phone_number))
         results = self.db.execute_query(query, (phone_number, client_id))
         return results[0] if results else {}
 
@@ -132,50 +713,108 @@ class LoanApplicationTracker:
     
     def create_application(self, client_id: str, phone_number: str, customer_name: str,
                           loan_amount: float = None, loan_purpose: str = None,
-                          monthly_income: float = None, employment_status: str = None) -> bool:
-        """Create new loan application"""
+                          monthly_income: float = None, employment_status: str = None) -> Optional[Dict]:
+        """Create new loan application and return its id, status and timestamps"""
         query = """
         INSERT INTO loan_applications (client_id, phone_number, customer_name, loan_amount, 
                                      loan_purpose, monthly_income, employment_status, 
-                                     application_status, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                     application_status)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id, application_status, created_at, updated_at
         """
         params = (client_id, phone_number, customer_name, loan_amount, loan_purpose,
-                 monthly_income, employment_status, 'pending', datetime.now(), datetime.now())
-        result = self.db.execute_query(query, params)
-        return result is not None
+                 monthly_income, employment_status, 'pending')
+        results = self.db.execute_query(query, params)
+        return results[0] if results else None
     
-    def update_application_status(self, phone_number: str, client_id: str, status: str) -> bool:
-        """Update application status"""
+    def update_application_status(self, phone_number: str, client_id: str, status: str) -> List[Dict]:
+        """Update application status and return the updated applications"""
         query = """
         UPDATE loan_applications 
-        SET application_status = %s, updated_at = %s 
+        SET application_status = %s, updated_at = now() 
         WHERE phone_number = %s AND client_id = %s
+        RETURNING id, application_status, updated_at
         """
-        result = self.db.execute_query(query, (status, datetime.now(), phone_number, client_id))
-        return result is not None
+        results = self.db.execute_query(query, (status, phone_number, client_id))
+        return results or []
     
     def get_customer_applications(self, phone_number: str, client_id: str) -> List[Dict]:
         """Get customer's loan applications"""
         query = """
-        SELECT * FROM loan_applications 
+        SELECT id, customer_name, loan_amount, loan_purpose, application_status, created_at
+        FROM loan_applications 
         WHERE phone_number = %s AND client_id = %s 
         ORDER BY created_at DESC
         """
         results = self.db.execute_query(query, (phone_number, client_id))
         return results or []
 
+# Idempotent schema adjustments applied on top of init-db-minimal.sql
+SCHEMA_STATEMENTS = [
+    # Timestamps are filled in by the server rather than sent as parameters
+    "ALTER TABLE clients ALTER COLUMN updated_at SET DEFAULT now()",
+    "ALTER TABLE loan_applications ALTER COLUMN created_at SET DEFAULT now()",
+    "ALTER TABLE loan_applications ALTER COLUMN updated_at SET DEFAULT now()",
+    # now() is fixed per statement; clock_timestamp() keeps batched rows in insert order
+    "ALTER TABLE conversations ALTER COLUMN timestamp SET DEFAULT clock_timestamp()",
+    # Per-customer lookups filter on (phone_number, client_id) and read newest first.
+    # Built CONCURRENTLY so live databases keep accepting writes (needs autocommit).
+    # No INCLUDE columns: every lookup reads message/response texts from the heap anyway,
+    # and TEXT values can exceed the btree row limit
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_conv_phone_client_ts_desc
+       ON conversations (phone_number, client_id, timestamp DESC)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_loanapp_phone_client_created
+       ON loan_applications (phone_number, client_id, created_at DESC)""",
+    # Superseded by the composite indexes above (CONCURRENTLY avoids an exclusive lock)
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_conversations_phone",
+    # Earlier covering version that rejected rows with long message/response texts
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_conv_phone_client_ts",
+    # Earlier version with an INCLUDE (customer_name) no query could use
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_conv_phone_client_time",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_loan_applications_phone",
+    "ANALYZE conversations",
+    "ANALYZE loan_applications",
+]
+
+# Indexes built CONCURRENTLY above; a failed build leaves an INVALID index that IF NOT EXISTS keeps
+CONCURRENT_INDEXES = ['idx_conv_phone_client_ts_desc', 'idx_loanapp_phone_client_created']
+
+def drop_invalid_indexes(db_manager: DatabaseManager) -> bool:
+    """Drop leftovers of failed concurrent index builds so they are built again"""
+    query = """
+    SELECT c.relname
+    FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+    WHERE NOT i.indisvalid AND c.relname = ANY(%s) AND pg_table_is_visible(c.oid)
+    """
+    results = db_manager.execute_query(query, (CONCURRENT_INDEXES,))
+    if results is None:
+        return False
+    for row in results:
+        logger.warning("⚠️ Rebuilding invalid index %s", row['relname'])
+        if not db_manager.execute_ddl(f"DROP INDEX CONCURRENTLY IF EXISTS {row['relname']}"):
+            return False
+    return True
+
 def initialize_database():
     """Initialize database with required tables (if not exists)"""
     db_manager = DatabaseManager()
     
-    if not db_manager.connection:
-        print("❌ Cannot initialize database - no connection")
+    if not db_manager.pool:
+        logger.error("❌ Cannot initialize database - no connection")
         return False
     
-    print("✅ Database initialization completed")
+    if not drop_invalid_indexes(db_manager):
+        return False
+    
+    for statement in SCHEMA_STATEMENTS:
+        if not db_manager.execute_ddl(statement):
+            return False
+    
+    logger.info("✅ Database initialization completed")
     return True
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(message)s")
     # Test database setup
     initialize_database()
\ No newline at end of file
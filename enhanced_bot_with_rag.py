@@ -1,64 +1,332 @@
 #!/usr/bin/env python3
-import json
 import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import queue
+import signal
+import socket
+import time
+import atexit
+import logging
+import logging.handlers
+import threading
+from typing import Dict, List, Optional, Tuple, Union
 
-print("DIAGNOSTIC BOT STARTING")
+import msgspec
+import orjson
+import redis
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from database_setup import create_redis_client
+
+class _RepeatFilter(logging.Filter):
+    """Drop records identical to one already logged within the last `window` seconds"""
+    
+    def __init__(self, window: float = 1.0, max_keys: int = 1024):
+        super().__init__()
+        self.window = window
+        self.max_keys = max_keys
+        self._seen: Dict[Tuple[int, str, str], float] = {}
+        self._lock = threading.Lock()
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Different exceptions under the same message are different diagnostics
+        error = record.exc_info[1] if record.exc_info else None
+        key = (record.levelno, record.getMessage(),
+               f"{type(error).__qualname__}: {error}" if error is not None else "")
+        now = time.monotonic()
+        with self._lock:
+            last = self._seen.get(key)
+            if last is not None and now - last < self.window:
+                return False
+            if len(self._seen) >= self.max_keys:
+                # Error bursts repeat a few messages; forget the stale ones
+                self._seen = {k: t for k, t in self._seen.items() if now - t < self.window}
+            self._seen[key] = now
+        return True
+
+# Handlers only enqueue records; a background thread does the actual stderr writes
+_log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_input = logging.handlers.QueueHandler(_log_queue)
+# QueueHandler pre-formats records; leave the layout to the output handler
+_log_input.setFormatter(logging.Formatter("%(message)s"))
+_log_input.addFilter(_RepeatFilter())
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING').upper(), handlers=[_log_input])
+
+def _start_log_listener():
+    """Start the thread that drains the log queue to stderr"""
+    global _log_listener
+    _log_listener = logging.handlers.QueueListener(_log_input.queue, _log_output)
+    _log_listener.start()
+
+def _restart_log_listener():
+    """Give a forked worker its own log queue; the parent's writer thread is not copied"""
+    _log_input.queue = queue.SimpleQueue()
+    _start_log_listener()
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_restart_log_listener)
+atexit.register(lambda: _log_listener.stop())
+logger = logging.getLogger("loanbot")
+
+# Webhook payloads are small; anything larger is rejected unread
+MAX_BODY = 64 * 1024
+
+# Longer texts are almost always forwards/broadcasts, not questions for the bot
+MAX_TEXT_CHARS = 2000
+
+# Redeliveries of the same message within this window are answered once
+DEDUPE_TTL = 120
+
+# Number of server processes sharing port 8080
+WEB_WORKERS = max(1, int(os.getenv('WEB_WORKERS', '1')))
+
+logger.info("DIAGNOSTIC BOT STARTING")
 whatsapp_token = os.getenv('MALAYSIAN_LOAN_WHATSAPP_TOKEN')
+# docker-compose passes the token through as WHATSAPP_TOKEN
+whatsapp_token_alt = os.getenv('WHATSAPP_TOKEN')
+has_whatsapp_token = bool(whatsapp_token or whatsapp_token_alt)
 openai_key = os.getenv('OPENAI_API_KEY')
-print(f"WhatsApp Token: {'SET' if whatsapp_token else 'MISSING'}")
-print(f"OpenAI Key: {'SET' if openai_key else 'MISSING'}")
+for name, present in (("WhatsApp Token", has_whatsapp_token), ("OpenAI Key", bool(openai_key))):
+    if present:
+        logger.info("%s: SET", name)
+    else:
+        logger.warning("%s: MISSING", name)
+
+# Fields accept null (and numeric ids/phones) like the dict-based parser did
+class WebhookText(msgspec.Struct):
+    body: Optional[str] = ""
+
+class WebhookMessage(msgspec.Struct):
+    id: Union[str, int, None] = None
+    from_: Union[str, int, float, None] = msgspec.field(name="from", default="")
+    text: Optional[WebhookText] = None
+    from_me: Optional[bool] = None
+
+class Webhook(msgspec.Struct):
+    messages: Optional[List[WebhookMessage]] = None
+
+_WEBHOOK_DECODER = msgspec.json.Decoder(Webhook)
 
-def process_webhook(webhook_data):
-    print("WEBHOOK RECEIVED:")
-    print(json.dumps(webhook_data, indent=2))
+# process_webhook returns one of these status keys; bodies are serialized once
+_RESP = {
+    status: orjson.dumps({"status": status})
+    for status in ("no_message", "ignored", "duplicate", "no_token", "diagnostic_complete", "error")
+}
+
+def claim_message(message_id: str) -> bool:
+    """Record a message id as being handled; False if it was already seen"""
+    try:
+        return bool(create_redis_client().set(f"dedupe:{message_id}", 1, nx=True, ex=DEDUPE_TTL))
+    except redis.RedisError as e:
+        # Without Redis a retry may be processed twice, which beats dropping it
+        logger.warning("Dedupe check skipped: %s", e)
+        return True
+
+def release_message(message_id: str):
+    """Forget a claimed message id so the provider's retry is processed again"""
     try:
-        messages = webhook_data.get('messages', [])
-        if not messages:
-            return {"status": "no_message"}
-        message = messages[0]
-        if message.get('from_me', False):
-            return {"status": "ignored"}
-        phone_number = message.get('from', '')
-        message_text = message.get('text', {}).get('body', '')
-        print(f"Phone: {phone_number}")
-        print(f"Message: {message_text}")
-        if not whatsapp_token:
-            print("NO WHATSAPP TOKEN!")
-            return {"status": "no_token"}
-        print("Would send response")
-        return {"status": "diagnostic_complete"}
-    except Exception as e:
-        print(f"ERROR: {e}")
-        return {"status": "error"}
+        create_redis_client().delete(f"dedupe:{message_id}")
+    except redis.RedisError as e:
+        logger.warning("Dedupe release failed: %s", e)
+
+def process_webhook(webhook: Webhook):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("WEBHOOK RECEIVED:\n%s", orjson.dumps(msgspec.to_builtins(webhook), option=orjson.OPT_INDENT_2).decode())
+    claimed = None
+    try:
+        if not webhook.messages:
+            return "no_message"
+        message = webhook.messages[0]
+        # Own echoes, non-text messages and oversized texts never need a reply
+        if message.from_me or message.text is None:
+            return "ignored"
+        message_text = message.text.body
+        if not message_text or len(message_text) > MAX_TEXT_CHARS:
+            return "ignored"
+        # Only the provider's message id identifies a retry; equal texts ("ok") can be genuine repeats
+        if message.id:
+            if not claim_message(str(message.id)):
+                return "duplicate"
+            claimed = str(message.id)
+        phone_number = "" if message.from_ is None else str(message.from_)
+        logger.debug("Phone: %s", phone_number)
+        logger.debug("Message: %s", message_text)
+        if not has_whatsapp_token:
+            logger.warning("NO WHATSAPP TOKEN!")
+            return "no_token"
+        logger.debug("Would send response")
+        return "diagnostic_complete"
+    except Exception:
+        logger.exception("ERROR processing webhook")
+        if claimed:
+            release_message(claimed)
+        return "error"
+
+# Tokens are only read at startup, so the health body never changes
+_HEALTH = orjson.dumps({"status": "diagnostic", "token": has_whatsapp_token},
+                       option=orjson.OPT_INDENT_2)
+_INDEX_HTML = b"<h1>Diagnostic Bot Running</h1>"
+
+# Status lines and per-route header blocks are encoded once and written with the body
+_STATUS_LINES = {
+    status: b"HTTP/1.1 %d %s\r\n" % (status, HTTPStatus(status).phrase.encode())
+    for status in (200, 400, 404, 411, 413)
+}
+_JSON_HEADERS = b"Content-Type: application/json\r\n"
+# Health and index bodies never change at runtime; let probes/proxies reuse them briefly
+_STATIC_JSON_HEADERS = _JSON_HEADERS + b"Cache-Control: public, max-age=5\r\n"
+_STATIC_HTML_HEADERS = b"Content-Type: text/html\r\nCache-Control: public, max-age=5\r\n"
 
 class WebhookHandler(BaseHTTPRequestHandler):
+    # Keep-alive lets probes and the provider reuse connections; idle ones are dropped
+    protocol_version = "HTTP/1.1"
+    timeout = 30
+
     def do_POST(self):
-        if self.path in ['/webhook', '/client/001/webhook']:
-            length = int(self.headers['Content-Length'])
-            data = json.loads(self.rfile.read(length))
-            result = process_webhook(data)
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(result).encode())
-        else:
-            self.send_response(404)
-            self.end_headers()
+        handler = self.POST_ROUTES.get(self.path)
+        if handler is None:
+            return self._reply(404, close=True)
+        return handler(self)
 
     def do_GET(self):
-        if self.path == '/health':
-            health = {"status": "diagnostic", "token": bool(whatsapp_token)}
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(health).encode())
-        else:
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(b"<h1>Diagnostic Bot Running</h1>")
-
-print("Starting server on port 8080...")
-server = HTTPServer(('0.0.0.0', 8080), WebhookHandler)
-server.serve_forever()
+        return self.GET_ROUTES.get(self.path, WebhookHandler._handle_index)(self)
+
+    def _handle_webhook(self):
+        header = self.headers.get('Content-Length')
+        if header is None or 'Transfer-Encoding' in self.headers:
+            # Chunked/unsized bodies are not supported; close so the body is not read as a request
+            return self._reply(411, close=True)
+        try:
+            length = int(header)
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self._reply(400, close=True)
+        if length > MAX_BODY:
+            return self._reply(413, close=True)
+        try:
+            webhook = _WEBHOOK_DECODER.decode(self.rfile.read(length))
+        except msgspec.ValidationError:
+            # Valid JSON in an unexpected shape: acknowledge so the provider doesn't retry it
+            return self._reply(200, _RESP["ignored"], _JSON_HEADERS)
+        except msgspec.DecodeError:
+            return self._reply(400)
+        result = process_webhook(webhook)
+        self._reply(200, _RESP.get(result) or orjson.dumps({"status": result}), _JSON_HEADERS)
+
+    def _handle_health(self):
+        self._reply(200, _HEALTH, _STATIC_JSON_HEADERS)
+
+    def _handle_index(self):
+        self._reply(200, _INDEX_HTML, _STATIC_HTML_HEADERS)
+
+    def log_message(self, format, *args):
+        # Access log goes through the logging queue instead of writing to stderr inline
+        logger.info("%s - %s", self.address_string(), format % args)
+
+    def _reply(self, status: int, body: bytes = b"", headers: bytes = b"", close: bool = False):
+        """Send status line, headers and body with a single write
+        
+        close drops the connection afterwards, for replies sent before the request body was read.
+        """
+        if close:
+            self.close_connection = True
+        head = b"%sDate: %s\r\nContent-Length: %d\r\n%s" % (
+            _STATUS_LINES[status], self.date_time_string().encode(), len(body), headers)
+        if self.close_connection:
+            head += b"Connection: close\r\n"
+        self.wfile.write(head + b"\r\n" + body)
+        self.log_request(status, len(body))
+
+    # Exact-path dispatch tables; unknown GET paths fall back to the index page
+    POST_ROUTES = {
+        '/webhook': _handle_webhook,
+        '/client/001/webhook': _handle_webhook,
+    }
+    GET_ROUTES = {
+        '/health': _handle_health,
+    }
+
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    """Threaded server whose port can be bound by several worker processes"""
+    
+    def server_bind(self):
+        if WEB_WORKERS > 1:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def serve():
+    """Run the webhook server in this process until it is stopped"""
+    logger.info("Starting server on port 8080 (pid %s)...", os.getpid())
+    server = ReusePortHTTPServer(('0.0.0.0', 8080), WebhookHandler)
+    server.serve_forever()
+
+_STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+def _spawn_worker(workers: Dict[int, float]):
+    """Fork a worker that binds its own socket and serves until signalled"""
+    # Hold stop signals until the pid is recorded, so the supervisor can always pass them on
+    signal.pthread_sigmask(signal.SIG_BLOCK, _STOP_SIGNALS)
+    try:
+        pid = os.fork()
+        if pid:
+            workers[pid] = time.monotonic()
+            return
+        # Drop the supervisor's handlers before any held signal is delivered
+        for signum in _STOP_SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+    finally:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, _STOP_SIGNALS)
+    try:
+        serve()
+    except BaseException:
+        logger.exception("Worker %s stopped", os.getpid())
+    finally:
+        # Never fall back into the supervisor loop; flush the log queue first
+        _log_listener.stop()
+        os._exit(1)
+
+def supervise():
+    """Keep WEB_WORKERS workers running; on SIGTERM stop and reap them all"""
+    workers: Dict[int, float] = {}
+    stopping = False
+    
+    def _stop(signum, frame):
+        # docker stop only signals PID 1, so pass it on to the workers
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    for signum in _STOP_SIGNALS:
+        signal.signal(signum, _stop)
+    
+    for _ in range(WEB_WORKERS):
+        if not stopping:
+            _spawn_worker(workers)
+    
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = workers.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logger.warning("Worker %s exited with status %s, restarting",
+                       pid, os.waitstatus_to_exitcode(status))
+        if time.monotonic() - started < 1:
+            # Crashing on startup (e.g. bind failure); don't spin
+            time.sleep(1)
+        if not stopping:
+            _spawn_worker(workers)
+
+# With several workers this process only supervises; the kernel balances accept() across them
+if WEB_WORKERS > 1:
+    supervise()
+else:
+    serve()
@@ -3,62 +3,104 @@
 Simple health check endpoint for Malaysian Loan Bot
 """
 
-import requests
 import sys
 import os
+import urllib.request
+import orjson
 from flask import Flask
 import threading
 import time
 
 app = Flask(__name__)
 
+# Fields read from the container environment, which does not change while running
+_STATIC_CHECKS = {
+    "status": "healthy",
+    "service": "Malaysian Loan Bot",
+    "client_id": os.getenv('CLIENT_ID', 'client_001'),
+    "memory_limit": os.getenv('PYTHON_MEMORY_LIMIT', '1000m'),
+    "rag_enabled": os.getenv('RAG_ENABLED', 'true').lower() == 'true'
+}
+
+def _json_response(payload, status):
+    """Serialize with orjson instead of Flask's stdlib JSON provider"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
+
+# Connections are opened on first use and shared by every health request
+_pg_pool = None
+_redis_client = None
+_clients_lock = threading.Lock()
+
+def _get_pg_pool():
+    """Return the shared Postgres pool, creating it on first use"""
+    global _pg_pool
+    if _pg_pool is None:
+        with _clients_lock:
+            if _pg_pool is None:
+                from psycopg2.pool import ThreadedConnectionPool
+                conn_string = f"host={os.getenv('POSTGRES_HOST', 'localhost')} port=5432 dbname={os.getenv('POSTGRES_DB', 'malaysian_loan_ai')} user={os.getenv('POSTGRES_USER', 'postgres')} password={os.getenv('POSTGRES_PASSWORD', '')}"
+                _pg_pool = ThreadedConnectionPool(1, 4, conn_string)
+    return _pg_pool
+
+def _get_redis():
+    """Return the shared Redis client, creating it on first use"""
+    global _redis_client
+    if _redis_client is None:
+        import redis
+        _redis_client = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=6379, decode_responses=True,
+                                    socket_connect_timeout=1, health_check_interval=30)
+    return _redis_client
+
 @app.route('/health')
 def health_check():
     """Basic health check endpoint"""
     try:
         # Basic system checks
-        checks = {
-            "status": "healthy",
-            "service": "Malaysian Loan Bot",
-            "timestamp": time.time(),
-            "client_id": os.getenv('CLIENT_ID', 'client_001'),
-            "memory_limit": os.getenv('PYTHON_MEMORY_LIMIT', '1000m'),
-            "rag_enabled": os.getenv('RAG_ENABLED', 'true').lower() == 'true'
-        }
+        checks = {**_STATIC_CHECKS, "timestamp": time.time()}
         
         # Check database connectivity if available
         try:
-            import psycopg2
-            conn_string = f"host={os.getenv('POSTGRES_HOST', 'localhost')} port=5432 dbname={os.getenv('POSTGRES_DB', 'malaysian_loan_ai')} user={os.getenv('POSTGRES_USER', 'postgres')} password={os.getenv('POSTGRES_PASSWORD', '')}"
-            conn = psycopg2.connect(conn_string)
-            conn.close()
+            pool = _get_pg_pool()
+            conn = pool.getconn()
+            broken = False
+            try:
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+            except:
+                # Drop the dead connection so the next check reconnects
+                broken = True
+                raise
+            finally:
+                pool.putconn(conn, close=broken)
             checks["database"] = "connected"
         except:
             checks["database"] = "disconnected"
             
         # Check Redis if available
         try:
-            import redis
-            r = redis.Redis(host=os.getenv('REDIS_HOST', 'localhost'), port=6379, decode_responses=True)
-            r.ping()
+            _get_redis().ping()
             checks["redis"] = "connected"
         except:
             checks["redis"] = "disconnected"
             
-        return checks, 200
+        return _json_response(checks, 200)
         
     except Exception as e:
-        return {
+        return _json_response({
             "status": "unhealthy",
             "error": str(e),
             "timestamp": time.time()
-        }, 500
+        }, 500)
 
 if __name__ == "__main__":
     # Run health check
     try:
-        response = requests.get("http://localhost:8080/health", timeout=5)
-        if response.status_code == 200:
+        # One request per process, so a pooled session would never be reused;
+        # the stdlib client also spares the probe the cost of importing requests
+        with urllib.request.urlopen("http://localhost:8080/health", timeout=5) as response:
+            status = response.status
+        if status == 200:
             print("✅ Health check passed")
             sys.exit(0)
         else:
@@ -24,7 +24,7 @@ CREATE TABLE IF NOT EXISTS conversations (
     message_text TEXT NOT NULL,
     response_text TEXT,
     message_type VARCHAR(20) DEFAULT 'text',
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    timestamp TIMESTAMP DEFAULT clock_timestamp(),
     processing_time_ms INTEGER,
     rag_used BOOLEAN DEFAULT false,
     escalated BOOLEAN DEFAULT false
@@ -70,9 +70,11 @@ INSERT INTO clients (client_id, client_name, status) VALUES
 ON CONFLICT (client_id) DO NOTHING;
 
 -- Create indexes for better performance (minimal for 2GB VPS)
-CREATE INDEX IF NOT EXISTS idx_conversations_phone ON conversations(phone_number);
+CREATE INDEX IF NOT EXISTS idx_conv_phone_client_ts_desc
+    ON conversations(phone_number, client_id, timestamp DESC);
 CREATE INDEX IF NOT EXISTS idx_conversations_timestamp ON conversations(timestamp);
-CREATE INDEX IF NOT EXISTS idx_loan_applications_phone ON loan_applications(phone_number);
+CREATE INDEX IF NOT EXISTS idx_loanapp_phone_client_created
+    ON loan_applications(phone_number, client_id, created_at DESC);
 CREATE INDEX IF NOT EXISTS idx_customer_documents_phone ON customer_documents(phone_number);
 
 -- Create a function to update timestamp
@@ -4,13 +4,43 @@ Simplified RAG System Stub for Malaysian Loan Bot
 (Minimal implementation to avoid dependency issues)
 """
 
+import os
+import re
+import heapq
+import logging
+import threading
+from functools import lru_cache
+from operator import itemgetter
+from typing import FrozenSet, List, Optional, Tuple
+
+logger = logging.getLogger("loanbot")
+
+_WORD = re.compile(r'\w+')
+
+# Distinct query word sets whose context is kept per RAG instance
+CONTEXT_CACHE_SIZE = 256
+
+def _tokens(text: str) -> FrozenSet[str]:
+    """Set of lowercased words in text"""
+    return frozenset(_WORD.findall(text.lower()))
+
+@lru_cache(maxsize=1024)
+def _query_tokens(query: str) -> FrozenSet[str]:
+    """Tokens of a query; repeated questions skip the tokenisation"""
+    return _tokens(query)
+
 class SimpleLoanRAG:
     """Simplified RAG system without heavy dependencies"""
     
     def __init__(self, knowledge_base_path: str = "/app/knowledge_base"):
         self.knowledge_base_path = knowledge_base_path
         self.documents = self.get_default_knowledge()
-        print("✅ Simple knowledge base initialized")
+        # Documents never change after load, so tokenise and format them once
+        self._doc_tokens = [_tokens(doc['title'] + ' ' + doc['content']) for doc in self.documents]
+        self._formatted = [f"{doc['title']}: {doc['content']}" for doc in self.documents]
+        # Context depends only on the query's word set, so reworded/repeated questions share entries
+        self._context_for_tokens = lru_cache(maxsize=CONTEXT_CACHE_SIZE)(self._build_context)
+        logger.info("✅ Simple knowledge base initialized")
     
     def get_default_knowledge(self):
         """Return default Malaysian loan knowledge"""
@@ -39,33 +69,36 @@ class SimpleLoanRAG:
     
     def search_knowledge(self, query: str, top_k: int = 3):
         """Simple keyword search without embeddings"""
-        query_lower = query.lower()
-        results = []
+        return [
+            {"document": self.documents[index], "similarity": score}
+            for score, index in self._rank(_query_tokens(query), top_k)
+        ]
+    
+    def _rank(self, query_tokens: FrozenSet[str], top_k: int) -> List[Tuple[float, int]]:
+        """(similarity, document index) of the best matches for a tokenised query, best first"""
+        if not query_tokens:
+            return []
         
-        for doc in self.documents:
-            # Simple keyword matching
-            content_lower = (doc['title'] + ' ' + doc['content']).lower()
-            if any(word in content_lower for word in query_lower.split()):
-                results.append({
-                    "document": doc,
-                    "similarity": 0.5  # Fixed similarity score
-                })
+        # Score by the share of query words the document contains
+        scored = ((len(query_tokens & doc_tokens) / len(query_tokens), index)
+                  for index, doc_tokens in enumerate(self._doc_tokens))
+        matches = [match for match in scored if match[0]]
         
-        return results[:top_k]
+        # Partial selection instead of a full sort; ties keep knowledge base order
+        return heapq.nlargest(top_k, matches, key=itemgetter(0))
     
     def get_relevant_context(self, query: str) -> str:
         """Get relevant context for a query"""
-        results = self.search_knowledge(query, top_k=2)
+        return self._context_for_tokens(_query_tokens(query))
+    
+    def _build_context(self, query_tokens: FrozenSet[str]) -> str:
+        """Join the pre-formatted best matching documents for a tokenised query"""
+        ranked = self._rank(query_tokens, top_k=2)
         
-        if not results:
+        if not ranked:
             return "No specific information found in knowledge base."
         
-        context_parts = []
-        for result in results:
-            doc = result["document"]
-            context_parts.append(f"{doc['title']}: {doc['content']}")
-        
-        return "\n\n".join(context_parts)
+        return "\n\n".join(self._formatted[index] for _, index in ranked)
     
     def enhance_response_with_knowledge(self, query: str, base_response: str) -> str:
         """Enhance response with relevant knowledge"""
@@ -76,7 +109,8 @@ class SimpleLoanRAG:
         
         # Simple enhancement
         enhanced_response = base_response
-        if len(base_response.split()) < 50:
+        # Splitting stops after 50 words, so long responses are not fully tokenised
+        if len(base_response.split(None, 49)) < 50:
             enhanced_response += f"\n\nAdditional information:\n{relevant_context}"
         
         return enhanced_response
@@ -98,12 +132,24 @@ class LoanRAGPresets:
             }
         ]
 
-# Initialize global RAG system
-rag_system = SimpleLoanRAG()
+# Global RAG system, built on first use so importing this module stays cheap
+rag_system: Optional[SimpleLoanRAG] = None
+_rag_lock = threading.Lock()
+
+def get_rag() -> SimpleLoanRAG:
+    """Return the shared RAG system, initializing it on first call"""
+    global rag_system
+    if rag_system is None:
+        with _rag_lock:
+            if rag_system is None:
+                rag_system = SimpleLoanRAG()
+    return rag_system
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(),
+                        format="%(asctime)s %(levelname)s %(message)s")
     # Test the RAG system
     test_query = "What are the requirements for a personal loan?"
-    context = rag_system.get_relevant_context(test_query)
+    context = get_rag().get_relevant_context(test_query)
     print(f"Query: {test_query}")
     print(f"Context: {context}")
\ No newline at end of file